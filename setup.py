@@ -8,11 +8,14 @@ except ImportError:
     def read_markdown(file: str) -> str:
         return open(file, "r").read()
 
+with open("requirements.txt", "r") as requirements_file:
+    requirements = [line.strip() for line in requirements_file if line.strip() and not line.strip().startswith("#")]
+
 setup(
     name="yaosadis",
     version="0.1.0",
     packages=find_packages(exclude=["tests"]),
-    install_requires=open("requirements.txt", "r").readlines(),
+    install_requires=requirements,
     url="https://github.com/wtsi-hgi/yaosadis",
     license="GPL3",
     description="Yet Another OpenStack Ansible Dynamic Inventory Script",
@@ -21,16 +21,49 @@
 import argparse
 import ast
 import json
+import logging
 import os
 import re
 import sys
 import types
 
+from collections import defaultdict
+from functools import lru_cache
+
 from jinja2 import Template
 from jinja2 import exceptions as jinja_exc
+from jinja2 import nodes
 
 from jinjath import TemplateWithSource, JinjaTemplateAction, set_template_kwargs
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson silently turns integers outside the 64-bit range into floats, so any
+# JSON containing a run of digits that long is left to the stdlib decoder
+LONG_DIGIT_RUN = re.compile(r'\d{19}')
+
+def json_loads(text):
+    if orjson is not None and not LONG_DIGIT_RUN.search(text):
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # e.g. NaN/Infinity, which the stdlib decoder accepts
+            pass
+    return json.loads(text)
+
+def json_dumps_bytes(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers outside the 64-bit range, which orjson cannot
+            # serialise but the stdlib encoder can
+            pass
+    return json.dumps(obj).encode()
+
 ###############################################################################
 # Default inventory name template:
 # names the ansible `inventory_name` after the (guaranteed unique) Terraform
@@ -90,85 +123,223 @@ DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE='{{ resource.type == "instance" }}'
 # triton_machine: primaryip
 # vsphere_virtual_machine: network_interface/ipv6_address, network_interface/ipv4_address
 ###############################################################################
-DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE="""ansible_host={{ accessIPv6
-                                                | default(accessIPv4, true)
-                                                | default(interface_ip, true)}}
+DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE="""ansible_host={{ resource.accessIPv6
+                                                | default(resource.accessIPv4, true)
+                                                | default(resource.interface_ip, true)}}
                                       {% set newline = joiner("\n") -%}
                                       {% for attr, value in resource.items() -%}
                                         {{ newline() }}os_{{ attr }}={{ value }}
                                       {%- endfor -%}
                                       """
 
+# every TemplateWithSource is created with these same options, so jinja2 builds
+# them all from a single shared (cached) Environment
 set_template_kwargs({'trim_blocks': True, 'lstrip_blocks': True, 'autoescape': False})
 
-def process_openstack_info(args, openstack_info):
+log = logging.getLogger("yaosadis")
+
+def reject_json_constant(constant):
+    raise ValueError("unsupported JSON constant %s" % (constant))
+
+@lru_cache(maxsize=4096)
+def literal_eval_host_var(value):
+    # host_var values with the same text (security groups, metadata, etc) tend
+    # to repeat across resources, so parse each distinct one only once; most
+    # are also valid JSON, which the C json decoder handles much faster. The
+    # stdlib decoder is used (rather than json_loads) as it keeps big integers
+    # exact, and NaN/Infinity are left to ast.literal_eval, which rejects them
+    try:
+        return json.loads(value, parse_constant=reject_json_constant)
+    except ValueError:
+        return ast.literal_eval(value)
+
+def get_literal_lines(template):
+    # a template without any jinja tags always renders to its own source, so
+    # its stripped, non-empty lines can be worked out once up front
+    source = template.source()
+    if '{{' in source or '{%' in source or '{#' in source:
+        return None
+    return [line.strip() for line in source.split('\n') if line.strip()]
+
+# names which jinja binds itself in some scope rather than looking them up in
+# the render context
+JINJA_SPECIAL_NAMES = frozenset(['self', 'loop', 'caller', 'varargs', 'kwargs'])
+
+def compile_simple_expression(node, environment):
+    # returns a function evaluating node against a render context, or None if
+    # node uses anything beyond plain variables, attribute lookups, constants
+    # and (in)equality comparisons; names that jinja resolves specially (such
+    # as `self`) are not plain variables
+    if isinstance(node, nodes.Const):
+        value = node.value
+        return lambda context: value
+    if isinstance(node, nodes.Name) and node.ctx == 'load':
+        if node.name in JINJA_SPECIAL_NAMES:
+            return None
+        name = node.name
+        def lookup_name(context):
+            if name in context:
+                return context[name]
+            if name in environment.globals:
+                return environment.globals[name]
+            return environment.undefined(name=name)
+        return lookup_name
+    if isinstance(node, nodes.Getattr) and node.ctx == 'load':
+        obj = compile_simple_expression(node.node, environment)
+        if obj is None:
+            return None
+        attr = node.attr
+        return lambda context: environment.getattr(obj(context), attr)
+    if isinstance(node, nodes.Compare) and len(node.ops) == 1 and node.ops[0].op in ('eq', 'ne'):
+        left = compile_simple_expression(node.expr, environment)
+        right = compile_simple_expression(node.ops[0].expr, environment)
+        if left is None or right is None:
+            return None
+        if node.ops[0].op == 'eq':
+            return lambda context: left(context) == right(context)
+        return lambda context: left(context) != right(context)
+    return None
+
+def compile_simple_template(template):
+    # templates that only substitute simple expressions into literal text
+    # (such as the default inventory name and resource filter templates) are
+    # rendered by joining pre-split segments rather than through the full jinja
+    # runtime; returns None for anything else so the caller can fall back to
+    # template.render
+    environment = template.environment
+    body = environment.parse(template.source()).body
+    if not body:
+        return lambda context: ""
+    if len(body) != 1 or not isinstance(body[0], nodes.Output):
+        return None
+    segments = []
+    for node in body[0].nodes:
+        if isinstance(node, nodes.TemplateData):
+            segments.append(node.data)
+            continue
+        expression = compile_simple_expression(node, environment)
+        if expression is None:
+            return None
+        segments.append(expression)
+    def render(context):
+        return "".join(segment if isinstance(segment, str) else str(segment(context)) for segment in segments)
+    return render
+
+def get_default_host_vars(resource_dict):
+    # used in place of rendering and parsing DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE,
+    # without round-tripping the resource attributes through text. This
+    # intentionally differs from the template for string attributes: those
+    # starting with '[' or '{' stay strings rather than being literal_eval'd,
+    # and multi-line strings stay whole rather than being split into lines
+    ansible_host = resource_dict.get('accessIPv6') or resource_dict.get('accessIPv4') or resource_dict.get('interface_ip') or ""
+    host_vars = {'ansible_host': str(ansible_host).strip()}
+    for attr, value in resource_dict.items():
+        if not isinstance(value, (list, dict)):
+            value = str(value).strip()
+        host_vars[sys.intern("os_%s" % (attr))] = value
+    return host_vars
+
+def process_openstack_info(args, openstack_info, host=None):
+    # if host is given, only the host_vars for that inventory_name are
+    # generated and groups are not rendered at all, as that is all that
+    # `--host` needs
     openstack_info_data = {}
-    groups = {}
+    groups = defaultdict(lambda: {'hosts': []})
     hosts = {}
+    inventory_names = set()
+    debug = log.isEnabledFor(logging.DEBUG)
+    # TemplateWithSource is a compiled jinja2 Template (built by
+    # JinjaTemplateAction or get_template_default); the templates that are
+    # actually needed are additionally parsed once per call here by
+    # compile_simple_template, so nothing is parsed inside the loop
+    resource_filter_template = args.ansible_resource_filter_template
+    inventory_name_template = args.ansible_inventory_name_template
+    groups_template = args.ansible_groups_template
+    host_vars_template = args.ansible_host_vars_template
+    render_resource_filter = compile_simple_template(resource_filter_template) or resource_filter_template.render
+    render_inventory_name = compile_simple_template(inventory_name_template) or inventory_name_template.render
+    literal_group_names = get_literal_lines(groups_template)
+    render_groups = None
+    if literal_group_names is None:
+        render_groups = compile_simple_template(groups_template) or groups_template.render
+    use_default_host_vars = host_vars_template.source() == DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE
+    render_host_vars = None
+    if not use_default_host_vars:
+        render_host_vars = compile_simple_template(host_vars_template) or host_vars_template.render
     for resource_uuid in openstack_info:
-        args.debug and print("Processing resource name %s" % (resource_uuid), file=sys.stderr)
-        host_vars = {}
-        resource = Resource(resource_uuid, openstack_info[resource_uuid])
+        if debug:
+            log.debug("Processing resource name %s", resource_uuid)
+        resource_dict = openstack_info[resource_uuid]
+        resource = {'uuid': resource_uuid, 'resource': resource_dict}
         try:
-            filter_value = args.ansible_resource_filter_template.render(resource)
+            filter_value = render_resource_filter(resource).strip()
         except jinja_exc.UndefinedError as e:
-            sys.exit("Error rendering resource filter template: %s (template was '%s')" % (e, args.ansible_resource_filter_template.source()))
+            sys.exit("Error rendering resource filter template: %s (template was '%s')" % (e, resource_filter_template.source()))
         if filter_value == "False":
             continue
         elif filter_value != "True":
-            raise ValueError("Unexpected value returned from ansible_resource_filter_template: %s (template was [%s])" % (filter_value, args.ansible_resource_filter_template.source()))
-        try:
-            inventory_name = args.ansible_inventory_name_template.render(resource)
-        except jinja_exc.UndefinedError as e:
-            sys.exit("Error rendering inventory name template: %s (template was '%s')" % (e, args.ansible_inventory_name_template.source()))
-        args.debug and print("Rendered ansible_inventory_name_template as '%s' for %s" % (inventory_name, resource_uuid), file=sys.stderr)
+            raise ValueError("Unexpected value returned from ansible_resource_filter_template: %s (template was [%s])" % (filter_value, resource_filter_template.source()))
         try:
-            group_names = re.split('\s*\n\s*', args.ansible_groups_template.render(resource))
+            inventory_name = render_inventory_name(resource)
         except jinja_exc.UndefinedError as e:
-            sys.exit("Error rendering groups template: %s (template was '%s')" % (e, args.ansible_groups_template.source()))
-        args.debug and print("Rendered ansible_groups_template as '%s' for %s" % (group_names, resource_uuid), file=sys.stderr)
-        for group_name in group_names:
-            if group_name not in groups:
-                groups[group_name] = {}
-                groups[group_name]['hosts'] = []
-            args.debug and print("'%s' added to group '%s' for %s" % (inventory_name, group_name, resource_uuid), file=sys.stderr)
-            groups[group_name]['hosts'].append(inventory_name)
-        try:
-            host_var_key_values = re.split('\s*\n\s*', args.ansible_host_vars_template.render(resource))
-        except jinja_exc.UndefinedError as e:
-            sys.exit("Error rendering host_vars template: %s (template was '%s')" % (e, args.ansible_host_vars_template.source()))
-        args.debug and print("Rendered ansible_host_vars_template as '%s' for %s" % (host_var_key_values, resource_uuid), file=sys.stderr)
-        for key_value in host_var_key_values:
-            key_value = key_value.strip()
-            if key_value == "":
-                continue
-            key_value = key_value.split('=', 1)
-            key = key_value[0].strip()
-            if len(key_value) < 2:
-                print("WARNING: no '=' in assignment '%s' rendered from ansible_host_vars_template [%s]" % (key_value, args.ansible_host_vars_template.source()), file=sys.stderr)
-                value = ""
+            sys.exit("Error rendering inventory name template: %s (template was '%s')" % (e, inventory_name_template.source()))
+        if debug:
+            log.debug("Rendered ansible_inventory_name_template as '%s' for %s", inventory_name, resource_uuid)
+        if inventory_name in inventory_names:
+            sys.exit("inventory_name was not unique across OpenStack resources: '%s' was a duplicate" % (inventory_name))
+        inventory_names.add(inventory_name)
+        if host is not None and inventory_name != host:
+            continue
+        if host is None:
+            if literal_group_names is not None:
+                group_names = literal_group_names
             else:
-                value = key_value[1].strip()
-                if value.startswith('['):
-                    value = ast.literal_eval(value)
-                elif value.startswith('{'):
-                    value = ast.literal_eval(value)
-            host_vars[key] = value
-            args.debug and print("host_var '%s' set to '%s' for %s" % (key, value, resource_uuid), file=sys.stderr)
-        if inventory_name not in hosts:
-            hosts[inventory_name] = host_vars
+                try:
+                    group_names = [sys.intern(line.strip()) for line in render_groups(resource).split('\n') if line.strip()]
+                except jinja_exc.UndefinedError as e:
+                    sys.exit("Error rendering groups template: %s (template was '%s')" % (e, groups_template.source()))
+                if debug:
+                    log.debug("Rendered ansible_groups_template as '%s' for %s", group_names, resource_uuid)
+            for group_name in group_names:
+                if debug:
+                    log.debug("'%s' added to group '%s' for %s", inventory_name, group_name, resource_uuid)
+                groups[group_name]['hosts'].append(inventory_name)
+        if use_default_host_vars:
+            host_vars = get_default_host_vars(resource_dict)
+            if debug:
+                log.debug("Generated default host_vars '%s' for %s", host_vars, resource_uuid)
         else:
-            sys.exit("inventory_name was not unique across OpenStack resources: '%s' was a duplicate" % (inventory_name))
-    openstack_info_data['groups'] = groups
+            host_vars = {}
+            try:
+                host_var_key_values = render_host_vars(resource).split('\n')
+            except jinja_exc.UndefinedError as e:
+                sys.exit("Error rendering host_vars template: %s (template was '%s')" % (e, host_vars_template.source()))
+            if debug:
+                log.debug("Rendered ansible_host_vars_template as '%s' for %s", host_var_key_values, resource_uuid)
+            for key_value in host_var_key_values:
+                key_value = key_value.strip()
+                if key_value == "":
+                    continue
+                key, sep, value = key_value.partition('=')
+                key = sys.intern(key.strip())
+                if not sep:
+                    print("WARNING: no '=' in assignment '%s' rendered from ansible_host_vars_template [%s]" % (key_value, host_vars_template.source()), file=sys.stderr)
+                    value = ""
+                else:
+                    value = value.strip()
+                    if value[:1] in ('[', '{'):
+                        value = literal_eval_host_var(value)
+                host_vars[key] = value
+                if debug:
+                    log.debug("host_var '%s' set to '%s' for %s", key, value, resource_uuid)
+        hosts[inventory_name] = host_vars
+    openstack_info_data['groups'] = dict(groups)
     openstack_info_data['hosts'] = hosts
     return openstack_info_data
 
 
 def list_groups(openstack_info_data):
-    meta = {"hostvars": openstack_info_data['hosts']}
-    list_with_meta = openstack_info_data['groups']
-    list_with_meta['_meta'] = meta
-    return list_with_meta
+    return {**openstack_info_data['groups'], '_meta': {"hostvars": openstack_info_data['hosts']}}
 
 def get_host(openstack_info_data, inventory_name):
     return openstack_info_data['hosts'].get(inventory_name, {})
@@ -185,25 +356,24 @@ def main():
     parser.add_argument('--ansible-groups-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped) of ansible `group` names to which the resource should belong. (default: environment variable OS_ANSIBLE_GROUPS_TEMPLATE or `%s`])" % (DEFAULT_ANSIBLE_GROUPS_TEMPLATE), default=get_template_default('OS_ANSIBLE_GROUPS_TEMPLATE', default=DEFAULT_ANSIBLE_GROUPS_TEMPLATE), action=JinjaTemplateAction)
     parser.add_argument('--ansible-resource-filter-template', help="A jinja2 template used to filter OpenStack resources. This template is rendered for each resource and should evaluate to either the string 'True' to include the resource or 'False' to exclude it from the output.", default=get_template_default('OS_ANSIBLE_RESOURCE_FILTER_TEMPLATE', default=DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE), action=JinjaTemplateAction)
     args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
-    args.debug and print("Parsing JSON from %s" % (args.openstack_info), file=sys.stderr)
-    openstack_info = json.load(args.openstack_info)
+    log.debug("Parsing JSON from %s", args.openstack_info)
+    openstack_info = json_loads(args.openstack_info.read())
     ansible_data = {}
-    args.debug and print("Processing openstack_info data", file=sys.stderr)
-    openstack_info_data = process_openstack_info(args, openstack_info)
+    log.debug("Processing openstack_info data")
     if args.list:
+        openstack_info_data = process_openstack_info(args, openstack_info)
         ansible_data = list_groups(openstack_info_data)
     elif args.host is not None:
+        openstack_info_data = process_openstack_info(args, openstack_info, host=args.host)
         ansible_data = get_host(openstack_info_data, args.host)
     else:
         sys.exit("nothing to do (please specify either '--list' or '--host <INVENTORY_NAME>')")
-    print(json.dumps(ansible_data))
-
+    sys.stdout.buffer.write(json_dumps_bytes(ansible_data))
+    sys.stdout.buffer.write(b"\n")
 
-class Resource(dict):
-    def __init__(self, resource_uuid, resource_dict):
-        super().__init__({'resource': resource_dict})
-        self['uuid'] = resource_uuid
 
 def get_template_default(*env_vars, default=''):
     template_source = None